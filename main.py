@@ -1,15 +1,27 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import create_engine, Column, Integer, String, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base
+from cachetools import TTLCache
 from dotenv import load_dotenv
 from io import BytesIO
-from datetime import datetime
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from operator import itemgetter
+from urllib.parse import quote_plus
 import pandas as pd
-import requests
+import asyncio
+import html
+import httpx
+import orjson
 import os
+import threading
 
 # ------------------ CONFIG ------------------
 load_dotenv()
@@ -21,7 +33,6 @@ if not YOUTUBE_API_KEY:
 engine = create_engine(
     "sqlite:///videos.db", connect_args={"check_same_thread": False}
 )
-SessionLocal = sessionmaker(bind=engine)
 Base = declarative_base()
 
 class ManualVideo(Base):
@@ -36,10 +47,45 @@ class ManualVideo(Base):
     url = Column(String)
     keywords = Column(String)
 
+# bumped on every upload so each worker can tell its manual cache is stale
+class ManualMeta(Base):
+    __tablename__ = "manual_meta"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
 Base.metadata.create_all(bind=engine)
+with engine.begin() as conn:
+    conn.execute(sqlite_insert(ManualMeta.__table__).values(id=1, version=0).on_conflict_do_nothing())
+
+MANUAL_COLUMNS = ["title", "channel", "published", "views", "likes", "comments", "url", "keywords"]
+
+# ------------------ RESPONSE MODEL ------------------
+@dataclass(slots=True)
+class Video:
+    title: str
+    channel: str
+    published: str
+    # None when the counts were not fetched (need_stats=false)
+    views: int | None
+    likes: int | None
+    comments: int | None
+    url: str
+    platform: str
+
+@dataclass(slots=True)
+class VideoList:
+    videos: list[Video]
+    total: int
 
 # ------------------ APP ------------------
-app = FastAPI(title="Multi-Source Video Dashboard")
+@asynccontextmanager
+async def lifespan(app):
+    open_client()
+    load_manual_cache()
+    yield
+    await client.aclose()
+
+app = FastAPI(title="Multi-Source Video Dashboard", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -55,100 +101,236 @@ def home():
     return FileResponse("static/index.html")
 
 # ------------------ EXCEL UPLOAD ------------------
+def read_excel_records(content):
+    df = pd.read_excel(BytesIO(content), engine="calamine").fillna("")
+    df.columns = df.columns.astype(str).str.strip().str.lower()
+    # "Title" and "title " collapse to the same label; keep the first one
+    df = df.loc[:, ~df.columns.duplicated()]
+    df = df.reindex(columns=MANUAL_COLUMNS, fill_value="")
+
+    for c in ("title", "channel", "url", "keywords"):
+        df[c] = df[c].astype(str)
+
+    # only dates and date strings are parsed; numbers (years, Excel serials) would
+    # otherwise read as epoch nanoseconds, so they keep the raw-string fallback
+    raw = df["published"]
+    if pd.api.types.is_datetime64_any_dtype(raw):
+        pub = raw
+    else:
+        numeric = pd.to_numeric(raw, errors="coerce").notna()
+        pub = pd.to_datetime(raw.mask(numeric), errors="coerce", format="mixed")
+    # blank cells in a datetime column stay NaT, and fall back to NaN
+    df["published"] = pub.dt.strftime("%Y-%m-%d").fillna(raw.astype(str).str[:10]).fillna("")
+    for c in ("views", "likes", "comments"):
+        counts = pd.to_numeric(df[c], errors="coerce").fillna(0)
+        # astype would wrap out-of-range values instead of raising
+        if (counts.abs() >= 2 ** 63).any():
+            raise HTTPException(400, f"Column '{c}' has values too large to store")
+        df[c] = counts.astype("int64")
+    df["keywords"] = df["keywords"].str.lower()
+    return df.to_dict("records")
+
+def replace_manual_videos(records):
+    table = ManualVideo.__table__
+    meta = ManualMeta.__table__
+    # built before the transaction so a bad record fails the upload, not the cache
+    cache = build_manual_cache(records)
+    with _manual_lock:
+        with engine.begin() as conn:
+            conn.execute(table.delete())
+            if records:
+                conn.execute(table.insert(), records)
+            conn.execute(meta.update().values(version=meta.c.version + 1))
+            version = manual_version(conn)
+        set_manual_cache(version, cache)
+
 @app.post("/upload-excel")
 async def upload_excel(file: UploadFile = File(...)):
     if not file.filename.lower().endswith((".xlsx", ".xls")):
         raise HTTPException(400, "Only Excel files allowed")
 
-    df = pd.read_excel(BytesIO(await file.read())).fillna("")
-    session = SessionLocal()
-    session.query(ManualVideo).delete()
-
-    for _, r in df.iterrows():
-        pub = r.get("published", "")
-        if isinstance(pub, (pd.Timestamp, datetime)):
-            pub = pub.strftime("%Y-%m-%d")
-        else:
-            pub = str(pub)[:10]
-
-        session.add(ManualVideo(
-            title=str(r.get("title", "")),
-            channel=str(r.get("channel", "")),
-            published=pub,
-            views=int(r.get("views", 0) or 0),
-            likes=int(r.get("likes", 0) or 0),
-            comments=int(r.get("comments", 0) or 0),
-            url=str(r.get("url", "")),
-            keywords=str(r.get("keywords", "")).lower()
+    records = await run_in_threadpool(read_excel_records, await file.read())
+    await run_in_threadpool(replace_manual_videos, records)
+    return {"status": "ok", "count": len(records)}
+
+# ------------------ YOUTUBE HELPERS ------------------
+SEARCH_URL = (
+    "https://www.googleapis.com/youtube/v3/search"
+    f"?part=snippet&type=video&maxResults=25&key={YOUTUBE_API_KEY}"
+)
+STATS_URL = f"https://www.googleapis.com/youtube/v3/videos?part=statistics&key={YOUTUBE_API_KEY}"
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+client = None
+_cache = TTLCache(maxsize=2048, ttl=300)
+# caps concurrent stats lookups to stay inside YouTube's per-second quota
+sem = asyncio.Semaphore(10)
+
+def open_client():
+    global client
+    client = httpx.AsyncClient(
+        timeout=20,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=2,
+            limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+        ),
+    )
+
+async def yt(url, retries=2):
+    key = url.replace(f"&key={YOUTUBE_API_KEY}", "")
+    data = _cache.get(key)
+    if data is not None:
+        return data
+
+    # upstream failures become 502s; the exception text includes the request URL,
+    # which carries the API key, so only the status is reported
+    try:
+        for attempt in range(retries + 1):
+            r = await client.get(url)
+            if r.status_code not in RETRY_STATUSES or attempt == retries:
+                break
+            await asyncio.sleep(0.2 * 2 ** attempt)
+        r.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        raise HTTPException(502, f"YouTube API request failed: HTTP {e.response.status_code}") from e
+    except httpx.HTTPError as e:
+        raise HTTPException(502, "YouTube API request failed") from e
+    data = _cache[key] = orjson.loads(r.content)
+    return data
+
+async def fetch_batch(ids):
+    async with sem:
+        return await yt(f"{STATS_URL}&id={','.join(ids)}")
+
+def _i(x):
+    return int(x) if x else 0
+
+# ------------------ MANUAL HELPERS ------------------
+# Manual videos only change on upload, so reads are served from memory as
+# parallel lists sorted by published, tagged with the manual_meta version they
+# were built from. Uploads bump that version in their transaction, so every
+# worker process notices and reloads. _manual_lock serializes uploads and
+# reloads in this process, keeping the cache in DB commit order.
+_manual_lock = threading.Lock()
+_manual_cache = (None, [], [], [])
+
+def manual_version(conn):
+    return conn.scalar(select(ManualMeta.version).where(ManualMeta.id == 1))
+
+def build_manual_cache(records):
+    records = sorted(records, key=itemgetter("published"))
+    return (
+        [r["published"] for r in records],
+        [r["keywords"] for r in records],
+        [Video(
+            title=r["title"],
+            channel=r["channel"],
+            published=r["published"],
+            views=r["views"],
+            likes=r["likes"],
+            comments=r["comments"],
+            url=r["url"],
+            platform="Manual"
+        ) for r in records],
+    )
+
+def set_manual_cache(version, cache):
+    global _manual_cache
+    _manual_cache = (version, *cache)
+
+def load_manual_cache():
+    with _manual_lock, engine.connect() as conn:
+        # version first: an upload landing before the row read then costs one
+        # extra reload instead of tagging stale rows as current
+        version = manual_version(conn)
+        if version == _manual_cache[0]:
+            return
+        rows = conn.execute(select(
+            ManualVideo.title,
+            ManualVideo.channel,
+            func.coalesce(ManualVideo.published, "").label("published"),
+            ManualVideo.views,
+            ManualVideo.likes,
+            ManualVideo.comments,
+            ManualVideo.url,
+            func.coalesce(ManualVideo.keywords, "").label("keywords"),
         ))
+        set_manual_cache(version, build_manual_cache([r._asdict() for r in rows]))
 
-    session.commit()
-    session.close()
-    return {"status": "ok", "count": len(df)}
+def manual_videos(q, start, end):
+    with engine.connect() as conn:
+        version = manual_version(conn)
+    if version != _manual_cache[0]:
+        load_manual_cache()
+    _, published, keywords, videos = _manual_cache
 
-# ------------------ YOUTUBE HELPERS ------------------
-def yt(url):
-    r = requests.get(url, timeout=30)
-    r.raise_for_status()
-    return r.json()
+    # undated rows sort first and always match, as before
+    undated = bisect_right(published, "")
+    lo = max(bisect_left(published, start), undated)
+    hi = bisect_right(published, end)
+    picked = chain(reversed(range(lo, hi)), range(undated))
+    return [videos[i] for i in picked if not q or q in keywords[i]]
 
 # ------------------ COMBINED API ------------------
 @app.get("/combined-videos")
-def combined_videos(query: str, start: str, end: str, source: str = "all"):
+async def combined_videos(
+    query: str,
+    start: str,
+    end: str,
+    source: str = "all",
+    need_stats: bool = True,
+) -> VideoList:
     videos = []
     q = query.lstrip("#").lower().strip()
 
     # ---------- YouTube ----------
     if source in ("all", "youtube"):
         search_url = (
-            "https://www.googleapis.com/youtube/v3/search"
-            f"?part=snippet&type=video&maxResults=25&q={q}"
+            f"{SEARCH_URL}&q={quote_plus(q)}"
             f"&publishedAfter={start}T00:00:00Z"
             f"&publishedBefore={end}T23:59:59Z"
-            f"&key={YOUTUBE_API_KEY}"
         )
-        data = yt(search_url)
-        ids = [i["id"]["videoId"] for i in data.get("items", [])]
-
-        if ids:
-            info = yt(
-                "https://www.googleapis.com/youtube/v3/videos"
-                f"?part=snippet,statistics&id={','.join(ids)}&key={YOUTUBE_API_KEY}"
-            )
-            for v in info.get("items", []):
-                s = v["snippet"]
-                st = v.get("statistics", {})
-                videos.append({
-                    "title": s["title"],
-                    "channel": s["channelTitle"],
-                    "published": s["publishedAt"][:10],
-                    "views": int(st.get("viewCount", 0)),
-                    "likes": int(st.get("likeCount", 0)),
-                    "comments": int(st.get("commentCount", 0)),
-                    "url": f"https://youtu.be/{v['id']}",
-                    "platform": "YouTube"
-                })
+        data = await yt(search_url)
+        items = data.get("items", [])
+
+        # search results already carry the snippet; videos.list is only needed for counts
+        stats = None
+        if need_stats:
+            ids = [i["id"]["videoId"] for i in items]
+            batches = [ids[i:i + 50] for i in range(0, len(ids), 50)]
+            infos = await asyncio.gather(*(fetch_batch(b) for b in batches))
+            stats = {}
+            for info in infos:
+                for v in info.get("items", ()):
+                    stats[v["id"]] = v.get("statistics") or {}
+
+        append = videos.append
+        for i in items:
+            vid = i["id"]["videoId"]
+            if stats is None:
+                views = likes = comments = None
+            elif vid in stats:
+                st = stats[vid]
+                views = _i(st.get("viewCount"))
+                likes = _i(st.get("likeCount"))
+                comments = _i(st.get("commentCount"))
+            else:
+                continue  # removed or made private since search indexed it
+            s = i["snippet"]
+            append(Video(
+                # search snippets are HTML-escaped, unlike videos.list
+                title=html.unescape(s["title"]),
+                channel=html.unescape(s["channelTitle"]),
+                published=s["publishedAt"][:10],
+                views=views,
+                likes=likes,
+                comments=comments,
+                url="https://youtu.be/" + vid,
+                platform="YouTube"
+            ))
 
     # ---------- Manual (Excel) ----------
     if source in ("all", "manual"):
-        session = SessionLocal()
-        rows = session.query(ManualVideo).all()
-        session.close()
-
-        for r in rows:
-            date_ok = not r.published or start <= r.published <= end
-            keyword_ok = not q or q in (r.keywords or "")
-
-            if date_ok and keyword_ok:
-                videos.append({
-                    "title": r.title,
-                    "channel": r.channel,
-                    "published": r.published,
-                    "views": r.views,
-                    "likes": r.likes,
-                    "comments": r.comments,
-                    "url": r.url,
-                    "platform": "Manual"
-                })
-
-    return {"videos": videos, "total": len(videos)}
+        videos.extend(await run_in_threadpool(manual_videos, q, start, end))
+
+    return VideoList(videos=videos, total=len(videos))